@@ -27,6 +27,7 @@ Original file is located at Google Colab
 !pip install gdown
 !pip install pykrige==1.7.2
 !pip install scikit-learn==1.0.2 #version to ensure compatibility
+!pip install pyarrow
 
 # Import libraries
 import matplotlib.pyplot as plt
@@ -47,10 +48,16 @@ from google.colab import files
 import gdown
 import geopandas as gpd
 from shapely.geometry import Point
+import shapely
 from scipy.interpolate import griddata
 from matplotlib.ticker import FuncFormatter
 from pykrige.ok import OrdinaryKriging
 import matplotlib.dates as mdates
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import os
 
 """#### **Level 1. Get landslide occurrence probability in Andean Zone with Chirps Data**"""
 
@@ -238,8 +245,29 @@ df_lluvia_l2['prob_ep']=y_pred_prob33p_2
 #Used file =CNE_IDEAM_andeanregion_figprob.shp (upload all the files of the folder)
 shapefile_archivo_l2 = files.upload()
 
+#Rain gauges catalogue: only the code (codigo_1) and the coordinates are read from the shapefile
+ #and saved as arrays sorted by code (int64 code, float64 x/y)
+def station_catalogue(nombre_archivo):
+    estaciones = gpd.read_file(nombre_archivo, columns=['codigo_1'])
+    orden = np.argsort(estaciones['codigo_1'].to_numpy(dtype='int64'), kind='stable')
+    return {'codigo': estaciones['codigo_1'].to_numpy(dtype='int64')[orden],
+            'x': estaciones.geometry.x.to_numpy(dtype='float64')[orden],
+            'y': estaciones.geometry.y.to_numpy(dtype='float64')[orden],
+            'crs': estaciones.crs}
+
+#Join values of rain gauges (exm: landslide probability) with the coordinates of the catalogue
+ #Codes are searched in the sorted catalogue (searchsorted), rows without rain gauge or without value are dropped
+def join_stations(catalogo, codigos, valores):
+    codigos = np.asarray(codigos, dtype='int64')
+    valores = np.asarray(valores, dtype='float64')
+    posicion = np.searchsorted(catalogo['codigo'], codigos)
+    posicion[posicion == len(catalogo['codigo'])] = 0
+    encontrado = (catalogo['codigo'][posicion] == codigos) & ~np.isnan(valores)
+    posicion = posicion[encontrado]
+    return catalogo['x'][posicion], catalogo['y'][posicion], valores[encontrado]
+
 #Read the shapefile (insert shp file name inside the argument)
-region_coordenadas_l2 = gpd.read_file('CNE_IDEAM_andeanregion_figprob.shp')
+estaciones_l2 = station_catalogue('CNE_IDEAM_andeanregion_figprob.shp')
 
 #Insert shapefile of area of interest
 #Used file = medellin2.shp (upload all the files of the folder)
@@ -250,11 +278,9 @@ uploaded=files.upload()
 
 limite_region_l2=gpd.read_file('medellin2.shp')
 
-#Merge probability occurrences with shapefile region
-df_prob_lluvia_l2= pd.merge(region_coordenadas_l2,df_lluvia_l2,how="left",left_on=['codigo_1'],right_on=['codigo'])
-
-#Drop missing data (Nan)
-df_prob_lluvia_l2=df_prob_lluvia_l2.dropna(subset=['prob_ep'])
+#Join probability occurrences with rain gauges coordinates (gauges without probability are dropped)
+x_l2, y_l2, prob_l2 = join_stations(estaciones_l2, df_lluvia_l2['codigo'], df_lluvia_l2['prob_ep'])
+points_l2 = np.column_stack([x_l2, y_l2])
 
 #Plot the data
 
@@ -264,19 +290,13 @@ df_prob_lluvia_l2=df_prob_lluvia_l2.dropna(subset=['prob_ep'])
 # ES. Se crea la figura
 fig, ax = plt.subplots(1, 1)
 
-#Selecct Lanslide probability > 0
-world_l2=df_prob_lluvia_l2[(df_prob_lluvia_l2.prob_ep>=0)]
-
 #Plot the region limit
 limite_region_l2.boundary.plot(ax=ax,color='purple', edgecolor='red')
 
 #Plot landslite probability
 ax.set_title("Landslide Probability with Ideam data", fontsize=12)
-world_l2.plot(column='prob_ep', cmap="YlGnBu",
-             ax=ax,
-             legend=True,
-             legend_kwds={'label': "Landslide probability [0-1]",
-                            'orientation': "vertical"})
+puntos = ax.scatter(x_l2, y_l2, c=prob_l2, cmap="YlGnBu")
+plt.colorbar(puntos, ax=ax, label="Landslide probability [0-1]", orientation="vertical")
 
 ax.xaxis.set_major_formatter(FuncFormatter(format_two_decimals))
 ax.yaxis.set_major_formatter(FuncFormatter(format_two_decimals))
@@ -295,15 +315,9 @@ plt.show()
 """###### **To get landslide occurrences probabilities for the whole map 2 interpolation methods are available: IDW and Splines**"""
 
 #IDW interpolation method
-#Select variables and create geodataframe
-variables = ['CODIGO', 'nombre', 'CATEGORIA', 'TECNOLOGIA', 'ESTADO',
-             'altitud', 'latitud', 'longitud', 'DEPARTAMEN', 'MUNICIPIO',
-             'geometry', 'prob_ep']
-gdf_l2 = gpd.GeoDataFrame(df_prob_lluvia_l2[variables], geometry='geometry')
-
-#Convert geometry to points
-points= np.array([[geom.x, geom.y] for geom in gdf_l2.geometry])
-values= gdf_l2['prob_ep'].values
+#Coordinates and probability of rain gauges
+points= points_l2
+values= prob_l2
 
 #Get region limits
 min_x, min_y, max_x, max_y = limite_region_l2.total_bounds
@@ -312,27 +326,34 @@ min_x, min_y, max_x, max_y = limite_region_l2.total_bounds
 grid_x, grid_y = np.mgrid[min_x:max_x:500j, min_y:max_y:500j]
 
 #Interpolation IDW function
-def idw_interpolation(x, y, values, xi, yi, power=2):
+ #Distances are calculated for blocks of grid points at once (vectorized). With max_distance, points farther
+ #than max_distance from every gauge are left without value (Nan)
+def idw_interpolation(x, y, values, xi, yi, power=2, max_distance=None, block=10000):
     # Inicialize results matrix. ES: Inicializar matriz de resultados
-    interpolated_values = np.zeros(xi.shape)
+    interpolated_values = np.zeros(xi.size)
+    xi_flat, yi_flat = xi.ravel(), yi.ravel()
 
-    # iterate on every point of the grid
-    for i in range(xi.shape[0]):
-        for j in range(xi.shape[1]):
-            #Calculate distance of point in grid
-            dist = np.sqrt((x - xi[i, j])**2 + (y - yi[i, j])**2)
+    # iterate on blocks of points of the grid
+    for inicio in range(0, xi.size, block):
+        bloque = slice(inicio, inicio + block)
 
-            #Avoid division by zero
+        #Calculate distance of every point of the block to every gauge
+        dist = np.sqrt((x[None, :] - xi_flat[bloque, None])**2 + (y[None, :] - yi_flat[bloque, None])**2)
 
-            if np.any(dist == 0):
-                interpolated_values[i, j] = values[dist.argmin()]
-            else:
-              #Calculate distance inverse weights
+        #Calculate distance inverse weights
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weights = 1 / dist**power
+            resultado = np.sum(weights * values, axis=1) / np.sum(weights, axis=1)
 
-                weights = 1 / dist**power
-                interpolated_values[i, j] = np.sum(weights * values) / np.sum(weights)
+        #Avoid division by zero: points over a gauge take the gauge value
+        cero = np.any(dist == 0, axis=1)
+        resultado[cero] = values[dist[cero].argmin(axis=1)]
 
-    return interpolated_values
+        if max_distance is not None:
+            resultado[dist.min(axis=1) > max_distance] = np.nan
+        interpolated_values[bloque] = resultado
+
+    return interpolated_values.reshape(xi.shape)
 
 #generate  IDW interpolation
 grid_z = idw_interpolation(points[:, 0], points[:, 1], values, grid_x, grid_y, power=2) # ES. el power 2 es estandar pero también puede ser 1 si se le quiere dar menor influencia a la distancia
@@ -356,19 +377,14 @@ cax = ax.imshow(grid_z.T, extent=(min_x, max_x, min_y, max_y),
 plt.colorbar(cax, label='Landslide probability [0-1]')
 
 #Points of original gauges
-gdf_l2.plot(ax=ax, markersize=20, color='yellow', edgecolor='black', marker='*')
+ax.scatter(x_l2, y_l2, s=20, color='yellow', edgecolor='black', marker='*')
 plt.show()
 
 #Splines interpolation method
 
-#Variables
-variables = ['CODIGO', 'nombre', 'CATEGORIA', 'TECNOLOGIA', 'ESTADO',
-             'altitud', 'latitud', 'longitud', 'DEPARTAMEN', 'MUNICIPIO',
-             'geometry', 'prob_ep']
-gdf_l2 = gpd.GeoDataFrame(df_prob_lluvia_l2[variables], geometry='geometry')
-
-points = np.array([[geom.x, geom.y] for geom in gdf_l2.geometry])
-values = gdf_l2['prob_ep'].values
+#Coordinates and probability of rain gauges
+points = points_l2
+values = prob_l2
 
 #Get region limits
 min_x, min_y, max_x, max_y = limite_region_l2.total_bounds
@@ -398,7 +414,7 @@ cax = ax.imshow(grid_z.T, extent=(min_x, max_x, min_y, max_y),
 plt.colorbar(cax, label='Landslide probability [0-1]')
 
 #Original gauges
-gdf_l2.plot(ax=ax, markersize=20, color='yellow', edgecolor='black', marker='*')
+ax.scatter(x_l2, y_l2, s=20, color='yellow', edgecolor='black', marker='*')
 plt.show()
 
 #Spline method expanded
@@ -407,9 +423,9 @@ plt.show()
 
 min_x, min_y, max_x, max_y = limite_region_l2.total_bounds
 
-#Convert geometry to points and get coordinates
-points = np.array([[geom.x, geom.y] for geom in gdf_l2.geometry])
-values = gdf_l2['prob_ep'].values  # ES.  Valores de probabilidad de deslizamiento
+#Coordinates of rain gauges
+points = points_l2
+values = prob_l2  # ES.  Valores de probabilidad de deslizamiento
 
 #Create artificial borders
 border_points = np.array([
@@ -450,7 +466,7 @@ cax = ax.imshow(grid_z.T, extent=(min_x, max_x, min_y, max_y),
 plt.colorbar(cax, label='Landslide probability [0-1]')
 
 #Original gauges points
-gdf_l2.plot(ax=ax, markersize=20, color='yellow', edgecolor='black', marker='*')
+ax.scatter(x_l2, y_l2, s=20, color='yellow', edgecolor='black', marker='*')
 plt.show()
 
 """
@@ -479,27 +495,180 @@ df_lluvia_l3= pd.read_csv(nombre_archivo_l3, encoding='latin-1')
 #Be sure the time column is in datetime format.
 df_lluvia_l3['fecha_hora'] = pd.to_datetime(df_lluvia_l3['fecha_hora'])
 
-#Function to organize data hourly
-
-def set_hourly(df, interval='minute'):
-  df['hora'] = df['fecha_hora'].dt.floor('h')  # Group by hours
-  hourly_data = df.groupby(['hora', 'Codigo']).agg({'P1': 'sum'}).reset_index()
-  hourly_data.rename(columns={'hora': 'fecha_hora', 'P1': 'rain_hourly'}, inplace=True)
-  return hourly_data
-
-#Get hourly data for preciptation
-hourly_data=set_hourly(df_lluvia_l3)
-
-#Function to organize data daily after hourly data
-
-def set_daily(df):
-  df['fecha'] = df['fecha_hora'].dt.date  # Group by day
-  daily_data = df.groupby(['fecha', 'Codigo']).agg({'rain_hourly': 'sum'}).reset_index()
-  daily_data.rename(columns={'rain_hourly': 'daily_rain'}, inplace=True)
-  return daily_data
-
-#Get daily data for preciptation
-daily_data=set_daily(hourly_data)
+#Columnar storage for level 3 rain gauge data
+ #Readings are saved in Parquet files partitioned by rain gauge (Codigo) and month (mes, YYYYMM),
+ #so new readings can be appended and only the last days of the needed gauges are read again.
+
+#Schema of the stored files: int64 timestamps (ns), float32 rain and int32 gauge code
+esquema_lluvia = pa.schema([('fecha_hora', pa.int64()), ('P1', pa.float32()),
+                            ('Codigo', pa.int32()), ('mes', pa.int32())])
+particion_lluvia = ds.partitioning(pa.schema([('Codigo', pa.int32()), ('mes', pa.int32())]), flavor='hive')
+#Only by month, for stores with many rain gauges/pixels and few readings each (exm: daily rain)
+particion_mes = ds.partitioning(pa.schema([('mes', pa.int32())]), flavor='hive')
+
+def compact_gauge_data(df):
+    #Keep only the level 3 columns (fecha_hora, P1, Codigo) with compact dtypes
+    #Readings without date or rain value are dropped (a missing date would be saved in a wrong month)
+    fecha_hora = pd.to_datetime(df['fecha_hora']).to_numpy().astype('datetime64[ns]')
+    validos = ~np.isnat(fecha_hora) & df['P1'].notna().to_numpy()
+    fecha_hora = fecha_hora[validos]
+    compact = pd.DataFrame({
+        'fecha_hora': fecha_hora.view('int64'),
+        'P1': df['P1'].to_numpy(dtype='float32')[validos],
+        'Codigo': df['Codigo'].to_numpy(dtype='int32')[validos],
+    })
+    #Month of each reading used as partition (exm: 202411)
+    mes = fecha_hora.astype('datetime64[M]').astype('int64')
+    compact['mes'] = (1970 + mes // 12) * 100 + mes % 12 + 1
+    compact['mes'] = compact['mes'].astype('int32')
+    return compact
+
+def append_gauge_store(df, store_dir, partitioning=particion_lluvia, max_files=8):
+    #Append new readings to the store; readings already stored (same Codigo and fecha_hora) are skipped
+    compact = compact_gauge_data(df).drop_duplicates(subset=['Codigo', 'fecha_hora'], keep='last')
+
+    #Keys stored in the months and rain gauges of the new readings (exm: the same file uploaded again)
+     #Late readings (older than the last stored one) are kept if they are not in the store
+    if os.path.isdir(store_dir) and len(compact) > 0:
+        dataset = ds.dataset(store_dir, format='parquet', schema=esquema_lluvia, partitioning=partitioning)
+        filtro = (ds.field('mes').isin(pa.array(compact['mes'].unique(), pa.int32())) &
+                  ds.field('Codigo').isin(pa.array(compact['Codigo'].unique(), pa.int32())))
+        guardados = dataset.to_table(columns=['Codigo', 'fecha_hora'], filter=filtro).to_pandas()
+        claves = pd.MultiIndex.from_arrays([guardados['Codigo'].astype('int32'), guardados['fecha_hora']])
+        nuevos = ~pd.MultiIndex.from_arrays([compact['Codigo'], compact['fecha_hora']]).isin(claves)
+        compact = compact[nuevos]
+    if len(compact) == 0:
+        return
+
+    table = pa.Table.from_pandas(compact, schema=esquema_lluvia, preserve_index=False)
+    ds.write_dataset(table, store_dir, format='parquet', partitioning=partitioning,
+                     basename_template=f'part-{pd.Timestamp.now().value}-{{i}}.parquet',
+                     existing_data_behavior='overwrite_or_ignore', max_partitions=max(len(table), 1))
+    merge_gauge_files(store_dir, compact, partitioning, max_files)
+
+def merge_gauge_files(store_dir, compact, partitioning=particion_lluvia, max_files=8):
+    #Every append writes new files; folders (rain gauge/month) with more than max_files files are merged in one file
+    dataset = ds.dataset(store_dir, format='parquet', schema=esquema_lluvia, partitioning=partitioning)
+    filtro = ds.field('mes').isin(pa.array(compact['mes'].unique(), pa.int32()))
+    if partitioning is particion_lluvia:
+        filtro = filtro & ds.field('Codigo').isin(pa.array(compact['Codigo'].unique(), pa.int32()))
+    carpetas = {}
+    for fragmento in dataset.get_fragments(filtro):
+        carpetas.setdefault(os.path.dirname(fragmento.path), []).append(fragmento.path)
+
+    for carpeta, archivos in carpetas.items():
+        if len(archivos) <= max_files:
+            continue
+        tabla = pa.concat_tables([pq.read_table(archivo, partitioning=None) for archivo in archivos])
+        tabla = tabla.sort_by('fecha_hora')
+        #Write the merged file first and then delete the old ones (read_gauge_store drops repeated readings)
+        pq.write_table(tabla, os.path.join(carpeta, f'part-{pd.Timestamp.now().value}-merged.parquet'))
+        for archivo in archivos:
+            os.remove(archivo)
+
+def read_gauge_store(store_dir, days=30, stations=None, end=None, partitioning=particion_lluvia):
+    #Read the last 'days' days (until 'end' or the last stored reading) for the selected rain gauges
+    dataset = ds.dataset(store_dir, format='parquet', schema=esquema_lluvia, partitioning=partitioning)
+    filtro = None
+    if stations is not None:
+        filtro = ds.field('Codigo').isin(np.asarray(stations, dtype='int32'))
+
+    if end is None:
+        #Months stored are taken from the folder names (mes=YYYYMM), and the last reading is read
+         #only from the most recent month with data of the selected rain gauges
+        meses = {ds.get_partition_keys(fragmento.partition_expression)['mes']
+                 for fragmento in dataset.get_fragments(filtro)}
+        for mes in sorted(meses, reverse=True):
+            filtro_mes = ds.field('mes') == mes
+            ultima = dataset.to_table(columns=['fecha_hora'],
+                                      filter=filtro_mes if filtro is None else filtro & filtro_mes)
+            if len(ultima) > 0:
+                end = pd.Timestamp(pc.max(ultima['fecha_hora']).as_py())
+                break
+        if end is None:
+            return pd.DataFrame({'fecha_hora': pd.Series(dtype='datetime64[ns]'),
+                                 'P1': pd.Series(dtype='float32'), 'Codigo': pd.Series(dtype='int32')})
+    end = pd.Timestamp(end)
+
+    #Whole days since the start of the window
+    inicio = (end - pd.Timedelta(days=days)).normalize()
+    mes_inicio = inicio.year * 100 + inicio.month
+    mes_fin = end.year * 100 + end.month
+
+    #Partition pruning by month, then filter by exact timestamps
+    filtro_tiempo = ((ds.field('mes') >= mes_inicio) & (ds.field('mes') <= mes_fin) &
+                     (ds.field('fecha_hora') >= inicio.as_unit('ns').value) &
+                     (ds.field('fecha_hora') <= end.as_unit('ns').value))
+    filtro = filtro_tiempo if filtro is None else filtro & filtro_tiempo
+    table = dataset.to_table(columns=['fecha_hora', 'P1', 'Codigo'], filter=filtro)
+
+    df = table.to_pandas()
+    df['fecha_hora'] = df['fecha_hora'].to_numpy().view('datetime64[ns]')
+    #Repeated readings can only exist if a merge of files was interrupted
+    df = df.drop_duplicates(subset=['Codigo', 'fecha_hora'], keep='last')
+    df = df.sort_values(by=['Codigo', 'fecha_hora'], ignore_index=True)
+    return df
+
+#Save uploaded readings in the store and read just the last 30 days (30 antecedent days plus the current day)
+store_lluvia_l3 = 'gauge_store_l3'
+append_gauge_store(df_lluvia_l3, store_lluvia_l3)
+df_lluvia_l3 = read_gauge_store(store_lluvia_l3, days=31)
+
+#Function to organize data hourly and daily in one pass
+ #Time is converted to integer hours (hours since 1970) and rain is summed by (hour, rain gauge) with np.bincount.
+ #Daily rain is summed from the hourly bins. Both results include the completeness of the data:
+ #fraction of the expected readings in the hour/day (exm: 5 readings of 60 in one hour = 0.083)
+ #time_step is the interval of the data (exm: pd.Timedelta(minutes=5)); a repeated time step is used once (last reading)
+
+def set_hourly_daily(df, time_step=pd.Timedelta(minutes=1)):
+  #Expected readings per hour depending on the interval of the data
+  ns_hora = 3600 * 10**9
+  ns_paso = pd.Timedelta(time_step).value
+  lecturas_hora = ns_hora / ns_paso
+
+  #Readings without rain value are not summed and do not count as received
+  validos = df['P1'].notna().to_numpy()
+  tiempo = df['fecha_hora'].to_numpy().astype('datetime64[ns]').view('int64')[validos]
+  lluvia = df['P1'].to_numpy(dtype='float64')[validos]
+  codigos, estacion = np.unique(df['Codigo'].to_numpy()[validos], return_inverse=True)
+
+  #Repeated readings (same rain gauge and time step) are used once, the last one is kept
+  clave_paso = (tiempo // ns_paso) * len(codigos) + estacion
+  _, ultimo = np.unique(clave_paso[::-1], return_index=True)
+  unicos = len(clave_paso) - 1 - ultimo
+  tiempo, lluvia, estacion = tiempo[unicos], lluvia[unicos], estacion[unicos]
+
+  #Hourly bins: integer hour index combined with rain gauge index
+  hora = tiempo // ns_hora
+  clave_hora, inverso = np.unique(hora * len(codigos) + estacion, return_inverse=True)
+  lluvia_hora = np.bincount(inverso, weights=lluvia, minlength=len(clave_hora))
+
+  #Received readings: time steps (exm: minutes) of every rain gauge in the hour
+  lecturas = np.bincount(inverso, minlength=len(clave_hora))
+  hora_bin, estacion_hora = np.divmod(clave_hora, len(codigos))
+
+  hourly_data = pd.DataFrame({
+      'fecha_hora': (hora_bin * ns_hora).view('datetime64[ns]'),
+      'Codigo': codigos[estacion_hora],
+      'rain_hourly': lluvia_hora,
+      'completeness': lecturas / lecturas_hora,
+  })
+
+  #Daily bins from the hourly bins
+  dia = hora_bin // 24
+  clave_dia, inverso_dia = np.unique(dia * len(codigos) + estacion_hora, return_inverse=True)
+  dia_bin, estacion_dia = np.divmod(clave_dia, len(codigos))
+
+  daily_data = pd.DataFrame({
+      'fecha': (dia_bin * 24 * ns_hora).view('datetime64[ns]'),
+      'Codigo': codigos[estacion_dia],
+      'daily_rain': np.bincount(inverso_dia, weights=lluvia_hora, minlength=len(clave_dia)),
+      'completeness': np.bincount(inverso_dia, weights=lecturas, minlength=len(clave_dia)) / (24 * lecturas_hora),
+  })
+  return hourly_data, daily_data
+
+#Get hourly and daily data for preciptation
+hourly_data, daily_data = set_hourly_daily(df_lluvia_l3)
 
 #Fuction to get cumulative rain (antecedent rain) from daily precipitation data
  #Specific format for model input
@@ -579,7 +748,7 @@ df_lluvia_l3['prob_ep']=y_pred_prob33p_3
 shapefile_archivo_l3 = files.upload()
 
 #Read shapefile (insert shp file inside the argument)
-region_coordenadas_l3 = gpd.read_file('CNE_mod.shp')
+estaciones_l3 = station_catalogue('CNE_mod.shp')
 
 #Insert shapefile of area of interest for level 3
 #Used file = barrio_sanantprado (Upload all the files of the folder)
@@ -588,29 +757,21 @@ uploaded=files.upload()
 #Read the region limit, area of interest
 limite_region_l3= gpd.read_file('barrio_sanantprado.shp')
 
-#Merge probability occurrences with shapefile region
-df_prob_lluvia_l3= pd.merge(region_coordenadas_l3,df_lluvia_l3,how="left",left_on=['codigo_1'],right_on=['codigo'])
-
-#Drop missing data (Nan)
-df_prob_lluvia_l3=df_prob_lluvia_l3.dropna(subset=['prob_ep'])
+#Join probability occurrences with rain gauges coordinates (gauges without probability are dropped)
+x_l3, y_l3, prob_l3 = join_stations(estaciones_l3, df_lluvia_l3['codigo'], df_lluvia_l3['prob_ep'])
+points_l3 = np.column_stack([x_l3, y_l3])
 
 #Plot the data
 
 fig,ax=plt.subplots(1,1)
 
-#Select landslide probability >0
-world_l3=df_prob_lluvia_l3[(df_prob_lluvia_l3.prob_ep>=0)]
-
 #Plot the region limit
 limite_region_l3.boundary.plot(ax=ax,color='purple', edgecolor='red')
 
 #Plot landslide probability
 ax.set_title("Landslide Probability with Ideam data", fontsize=12)
-world_l3.plot(column='prob_ep', cmap="YlGnBu",
-             ax=ax,
-             legend=True,
-             legend_kwds={'label': "Landslide probability [0-1]",
-                            'orientation': "vertical"})
+puntos = ax.scatter(x_l3, y_l3, c=prob_l3, cmap="YlGnBu")
+plt.colorbar(puntos, ax=ax, label="Landslide probability [0-1]", orientation="vertical")
 ax.xaxis.set_major_formatter(FuncFormatter(format_two_decimals))
 ax.yaxis.set_major_formatter(FuncFormatter(format_two_decimals))
 
@@ -624,14 +785,9 @@ plt.show()
 
 #Interpolate data with IDW method
 
-variables= ['CODIGO', 'nombre', 'CATEGORIA', 'TECNOLOGIA', 'ESTADO',
-             'altitud', 'latitud', 'longitud', 'DEPARTAMEN', 'MUNICIPIO',
-             'geometry', 'prob_ep']
-
-gdf_l3 = gpd.GeoDataFrame(df_prob_lluvia_l3[variables], geometry='geometry')
-
-points = np.array([[geom.x, geom.y] for geom in gdf_l3.geometry])
-values = gdf_l3['prob_ep'].values
+#Coordinates and probability of rain gauges
+points = points_l3
+values = prob_l3
 
 #Get region limits
 min_x, min_y, max_x, max_y = limite_region_l3.total_bounds
@@ -663,7 +819,7 @@ cax = ax.imshow(grid_z.T, extent=(min_x, max_x, min_y, max_y),
 plt.colorbar(cax, label='Landslide probability [0-1]')
 
 #Points of original gauges
-#gdf_l3.plot(ax=ax, markersize=20, color='yellow', edgecolor='black', marker='*')
+#ax.scatter(x_l3, y_l3, s=20, color='yellow', edgecolor='black', marker='*')
 plt.show()
 
 #Chose scenario to define empirical rainfall thresholds.
@@ -679,6 +835,11 @@ scenarios = {
     "3": "Fine soils in rainy periods"
 }
 
+#Empirical rainfall thresholds (mm) for every scenario
+ #24 hours thresholds apply to the first 15 hours, 30 days thresholds of scenarios 2 and 3 apply to the first 15 days
+umbrales_24h = {1: [], 2: [30, 60], 3: [40]}
+umbrales_30d = {1: [200], 2: [100], 3: [150]}
+
 #Show options to user
 print("Please choose one of the following scenarios:")
 for key, value in scenarios.items():
@@ -696,105 +857,927 @@ while True:
 
 selected=int(seleccion)
 
-# ------ Plot cumulated rain in the last 24h ------
-def plot_24h(df_hourly, scenario):
-    #Ensure datetime format
-    df_hourly['fecha_hora'] = pd.to_datetime(df_hourly['fecha_hora'], errors='coerce')
-
-    #Delete invalid rows
-    df_hourly = df_hourly.dropna(subset=['fecha_hora'])
-
-    #Filter last 24 hours
-    ultima_fecha_hora = df_hourly['fecha_hora'].max()
-    inicio_24h = ultima_fecha_hora - pd.Timedelta(hours=23)
-
-    # Create dataframe last 24 hours
-    filtro_24h = df_hourly [(df_hourly['fecha_hora'] >= inicio_24h) & (df_hourly['fecha_hora'] <= ultima_fecha_hora)]
-    filtro_24h = filtro_24h.sort_values(by='fecha_hora')
-
-    plt.figure(figsize=(7, 5))
-
-    # Plot the data by rain gauge
-    estaciones = filtro_24h['Codigo'].unique()
-    for estacion in estaciones:
-        datos_estacion = filtro_24h[filtro_24h['Codigo'] == estacion].copy()
-        datos_estacion['Accumulated Rain'] = datos_estacion['rain_hourly'].cumsum()
-        plt.plot(datos_estacion['fecha_hora'], datos_estacion['Accumulated Rain'], marker='o', label=f'Rain gauge {estacion}')
-
-    # Add rainfall threshold according to the scenario
-    if scenario == 2:
-        # Scenario #2
-        horas = filtro_24h['fecha_hora'].unique()[:16]  # Select first 15 hours (0-15h)
-        plt.plot(horas, [30] * len(horas), color='red', linestyle='--', label='Threshold 30mm (0-15h)')
-        plt.plot(horas, [60] * len(horas), color='red', linestyle='--', label='Threshold 60mm (0-15h)')
-    elif scenario == 3:
-        # #Scenario #3
-        horas = filtro_24h['fecha_hora'].unique()[:16]  # Select first 15 hours (0-15h)
-        plt.plot(horas, [40] * len(horas), color='red', linestyle='--', label='Threshold 40mm (0-15h)')
-
-    # Plot settings
-    plt.gca().xaxis.set_major_formatter(mdates.DateFormatter('%Hh'))  # Formato del eje X
-    plt.xticks(rotation=0)
-    plt.title('Cumulative rain in the last 24 hours')
-    plt.xlabel('Hour')
-    plt.ylabel('Cumulative rain (mm)')
-    plt.legend()
-    plt.grid(True)
-    plt.tight_layout()
-    plt.show()
-
-
-plot_24h(hourly_data, selected)
-
-# ------ Plot cumulative rain in the last 30 days ------
-def plot_30days(df_daily, scenario):
-
-    #Ensure datetime format
-    df_daily['fecha'] = pd.to_datetime(df_daily['fecha'], errors='coerce')
-
-    #Delete invalid rows
-    df_daily = df_daily.dropna(subset=['fecha'])
-
-    #Filter last 30 days
-    ultima_fecha = df_daily['fecha'].max()
-    inicio_30d = ultima_fecha - pd.Timedelta(days=29)
-
-    #Create dataframe 30 days
-    filtro_30d = daily_data[(daily_data['fecha'] >= inicio_30d) & (daily_data['fecha'] <= ultima_fecha)]
-    filtro_30d = filtro_30d.sort_values(by='fecha')
-
-    plt.figure(figsize=(10, 6))
-
-    # Plot cumulative rain by rain gauge
-    estaciones = filtro_30d['Codigo'].unique()
-    for estacion in estaciones:
-        datos_estacion = filtro_30d[filtro_30d['Codigo'] == estacion].copy()
-        datos_estacion['Accumulated Rain'] = datos_estacion['daily_rain'].cumsum()
-        plt.plot(datos_estacion['fecha'], datos_estacion['Accumulated Rain'], marker='o', label=f'Rain gauge {estacion}')
-
-    # Add rainfall threshold depending on the scenario
-    if scenario == 1:
-        # Scenario 1
-        plt.axhline(y=200, color='red', linestyle='--', label='Threshold 200mm')
-    elif scenario == 2:
-        # Scenario 2
-        dias = filtro_30d['fecha'].unique()[:16]  # Seleccionar los primeros 16 días (0-15 días)
-        plt.plot(dias, [100] * len(dias), color='red', linestyle='--', label='Threshold 100mm (0-15 days)')
-    elif scenario == 3:
-        # Scenario 3
-        dias = filtro_30d['fecha'].unique()[:16]  # Seleccionar los primeros 16 días (0-15 días)
-        plt.plot(dias, [150] * len(dias), color='red', linestyle='--', label='Threshold 150mm (0-15 days)')
-
-    # Plot settings
-    plt.title('Cumulative rain in the last 30 days')
-    plt.xlabel('Day')
-    plt.xticks(rotation=45)
-    plt.ylabel('Cumulative rain (mm)')
-    plt.legend()
-    plt.grid(True)
-    plt.tight_layout()
-    plt.show()
-
-
-plot_30days(daily_data, selected)
+#Charts of cumulative rain (last 24 hours and last 30 days) with the empirical rainfall thresholds of the scenario
+ #Cumulative rain of every rain gauge is calculated with one grouped cumsum and all the gauges of a chart are drawn as
+ #one line collection. Charts are saved as files (PNG/SVG) in parallel processes, without showing them.
+
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
+from matplotlib.lines import Line2D
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+def cumulative_curves(df, time_col, rain_col, span):
+    #Cumulative rain by rain gauge in the last period (span) of the data
+    df = df.assign(tiempo=pd.to_datetime(df[time_col], errors='coerce')).dropna(subset=['tiempo'])
+    ultimo = df['tiempo'].max()
+    df = df[(df['tiempo'] >= ultimo - span) & (df['tiempo'] <= ultimo)].sort_values(by=['Codigo', 'tiempo'], ignore_index=True)
+    df['Accumulated Rain'] = df.groupby('Codigo')[rain_col].cumsum()
+    return df[['Codigo', 'tiempo', 'Accumulated Rain']]
+
+def draw_curves(ax, curvas, scenario, periodo):
+    #Cumulative rain of every rain gauge (one line collection) and thresholds of the scenario
+    x = mdates.date2num(curvas['tiempo'].to_numpy())
+    y = curvas['Accumulated Rain'].to_numpy()
+    codigos = curvas['Codigo'].to_numpy()
+    cortes = np.flatnonzero(np.diff(codigos)) + 1
+    estaciones = codigos[np.r_[0, cortes]] if len(codigos) else codigos
+    colores = plt.colormaps['tab10' if len(estaciones) <= 10 else 'viridis'](np.linspace(0, 1, max(len(estaciones), 1)))
+    ax.add_collection(LineCollection([np.column_stack(linea) for linea in zip(np.split(x, cortes), np.split(y, cortes))],
+                                     colors=colores, linewidths=1))
+    leyenda = []
+    if len(estaciones) <= 10:
+        #Few rain gauges: show the points and the name of every rain gauge
+        ax.scatter(x, y, s=12, color=np.repeat(colores, np.diff(np.r_[0, cortes, len(x)]), axis=0))
+        leyenda = [Line2D([], [], color=color, marker='o', label=f'Rain gauge {codigo}') for codigo, color in zip(estaciones, colores)]
+
+    #Thresholds (first 16 hours/days, or the whole period for the 30 days threshold of scenario 1)
+    umbrales, unidad = (umbrales_24h, 'h') if periodo == '24h' else (umbrales_30d, ' days')
+    tiempos = np.unique(x)
+    inicio, fin = (tiempos[0], tiempos[min(15, len(tiempos) - 1)]) if len(tiempos) else (0, 0)
+    for umbral in umbrales[scenario]:
+        if periodo == '30days' and scenario == 1:
+            ax.axhline(y=umbral, color='red', linestyle='--')
+            leyenda.append(Line2D([], [], color='red', linestyle='--', label=f'Threshold {umbral}mm'))
+        else:
+            ax.hlines(umbral, inicio, fin, color='red', linestyle='--')
+            leyenda.append(Line2D([], [], color='red', linestyle='--', label=f'Threshold {umbral}mm (0-15{unidad})'))
+
+    #Plot settings
+    ax.autoscale_view()
+    ax.xaxis_date()
+    #Fixed locators, the automatic date locator is slow with many charts
+    if periodo == '24h':
+        ax.xaxis.set_major_locator(mdates.HourLocator(interval=3))
+        ax.xaxis.set_major_formatter(mdates.DateFormatter('%Hh'))
+        ax.set_title('Cumulative rain in the last 24 hours')
+        ax.set_xlabel('Hour')
+    else:
+        ax.xaxis.set_major_locator(mdates.DayLocator(interval=3))
+        ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
+        ax.tick_params(axis='x', labelrotation=45)
+        ax.set_title('Cumulative rain in the last 30 days')
+        ax.set_xlabel('Day')
+    ax.set_ylabel('Cumulative rain (mm)')
+    if leyenda:
+        ax.legend(handles=leyenda, fontsize=8)
+    ax.grid(True)
+
+def render_threshold_page(curvas_24h, curvas_30d, titulo, ruta, scenario, formats, small_multiples):
+    #One file with the two charts for all the rain gauges, or one row of charts by rain gauge (small multiples)
+    if small_multiples:
+        estaciones = np.union1d(curvas_24h['Codigo'].unique(), curvas_30d['Codigo'].unique())
+        fig = Figure(figsize=(14, 3.5 * len(estaciones)))
+        axes = fig.subplots(len(estaciones), 2, squeeze=False, sharex='col')
+        for fila, codigo in zip(axes, estaciones):
+            draw_curves(fila[0], curvas_24h[curvas_24h['Codigo'] == codigo], scenario, '24h')
+            draw_curves(fila[1], curvas_30d[curvas_30d['Codigo'] == codigo], scenario, '30days')
+            fila[0].set_title(f'Rain gauge {codigo} - last 24 hours')
+            fila[1].set_title(f'Rain gauge {codigo} - last 30 days')
+    else:
+        fig = Figure(figsize=(17, 6))
+        axes = fig.subplots(1, 2)
+        draw_curves(axes[0], curvas_24h, scenario, '24h')
+        draw_curves(axes[1], curvas_30d, scenario, '30days')
+    fig.suptitle(titulo)
+    #Fixed margins (tight_layout measures every text of the charts again)
+    fig.subplots_adjust(left=0.06, right=0.98, bottom=0.22 if not small_multiples else 0.4 / len(axes),
+                        top=0.9 if not small_multiples else 1 - 0.4 / len(axes), wspace=0.2, hspace=0.6)
+    archivos = []
+    for formato in formats:
+        fig.savefig(f'{ruta}.{formato}', dpi=120)
+        archivos.append(f'{ruta}.{formato}')
+    return archivos
+
+def render_threshold_charts(df_hourly, df_daily, scenario, output, groups=None, per_station=False,
+                            stations_per_page=12, formats=('png', 'svg'), workers=4):
+    #groups: {name: rain gauge codes (None = all)}, one file by group (exm: by region)
+    #per_station: also files with small multiples of every rain gauge (stations_per_page gauges by file)
+    os.makedirs(output, exist_ok=True)
+    curvas_24h = cumulative_curves(df_hourly, 'fecha_hora', 'rain_hourly', pd.Timedelta(hours=23))
+    curvas_30d = cumulative_curves(df_daily, 'fecha', 'daily_rain', pd.Timedelta(days=29))
+
+    paginas = []
+    for nombre, codigos in (groups or {'all': None}).items():
+        c24 = curvas_24h if codigos is None else curvas_24h[curvas_24h['Codigo'].isin(codigos)]
+        c30 = curvas_30d if codigos is None else curvas_30d[curvas_30d['Codigo'].isin(codigos)]
+        if len(c24) == 0 and len(c30) == 0:
+            print(f"Chart of {nombre} not saved: no rain gauges with data in this group")
+            continue
+        paginas.append((c24, c30, f'Rain gauges: {nombre}', os.path.join(output, f'thresholds_{nombre}'), scenario, formats, False))
+    if per_station:
+        estaciones = np.union1d(curvas_24h['Codigo'].unique(), curvas_30d['Codigo'].unique())
+        for i in range(0, len(estaciones), stations_per_page):
+            pagina = estaciones[i:i + stations_per_page]
+            paginas.append((curvas_24h[curvas_24h['Codigo'].isin(pagina)], curvas_30d[curvas_30d['Codigo'].isin(pagina)],
+                            f'Rain gauges {pagina[0]} - {pagina[-1]}',
+                            os.path.join(output, f'thresholds_stations_{i // stations_per_page + 1:03d}'),
+                            scenario, formats, True))
+
+    #"fork" lets the processes use the functions defined in this notebook
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as pool:
+        return [archivo for archivos in pool.map(render_threshold_page, *zip(*paginas)) for archivo in archivos] if paginas else []
+
+def stations_near_region(catalogo, limite, radius):
+    #Codes of the rain gauges inside the region or at less than 'radius' (in the units of the region CRS)
+    puntos = gpd.GeoSeries(gpd.points_from_xy(catalogo['x'], catalogo['y']), crs=catalogo['crs']).to_crs(limite.crs)
+    return catalogo['codigo'][shapely.dwithin(limite.union_all(), puntos.values, radius)]
+
+#Distance (degrees) where a rain gauge gives information of an area, also used for the interpolation of the pipeline
+radio_influencia = 0.05
+
+#Rain gauges of the area of interest (inside or near the limit, the area can be smaller than the distance between gauges)
+estaciones_region_l3 = stations_near_region(estaciones_l3, limite_region_l3, radio_influencia)
+
+#Save the charts of all the rain gauges, of the area of interest and of every rain gauge
+archivos_umbrales = render_threshold_charts(hourly_data, daily_data, selected, 'threshold_charts',
+                                            groups={'all': None, 'sanantprado': estaciones_region_l3}, per_station=True)
+print("Charts saved:", archivos_umbrales)
+
+"""
+#### **Level 3 with continuous rain gauge data**
+
+If rain gauge readings arrive continuously (many stations, every minute), this service receives them, checks them and processes them in micro-batches:
+hourly/daily rain, antecedent rain, landslide probability with the Ideam model and empirical rainfall thresholds."""
+
+#Readings are received in two ways (same format as level 3 file: fecha_hora,P1,Codigo):
+ #1. TCP connection: one reading per line (exm: 11/1/2024 00:02,0.2,27010770). Send the line METRICS to get the queue state.
+ #2. Drop directory: csv files copied into the folder are read and moved to the subfolder 'procesados'
+
+import asyncio
+import contextlib
+import json
+import shutil
+import tempfile
+
+#Queue and batch metrics of the service
+metricas_servicio = {'received': 0, 'invalid': 0, 'rejected_files': 0, 'batches': 0, 'queue_depth': 0,
+                     'max_queue_depth': 0, 'errors': 0, 'task_errors': 0, 'last_batch_size': 0,
+                     'last_batch_seconds': 0.0, 'port': None}
+
+def validate_reading(fecha_hora, p1, codigo):
+    #Return the reading with the right types or None if it is not valid
+    try:
+        fecha_hora = pd.Timestamp(str(fecha_hora).strip())
+        p1 = float(p1)
+        codigo = int(float(codigo))
+    except (ValueError, TypeError):
+        return None
+    if pd.isna(fecha_hora) or not np.isfinite(p1) or p1 < 0:
+        return None
+    return (fecha_hora, p1, codigo)
+
+async def put_reading(queue, reading):
+    #Wait when the queue is full (backpressure): intake stops until the batches free space
+    if reading is None:
+        metricas_servicio['invalid'] += 1
+        return
+    await queue.put(reading)
+    metricas_servicio['received'] += 1
+    metricas_servicio['queue_depth'] = queue.qsize()
+    metricas_servicio['max_queue_depth'] = max(metricas_servicio['max_queue_depth'], queue.qsize())
+
+async def tcp_intake(queue, host='127.0.0.1', port=8765):
+    #TCP server, the connection is not read while put_reading waits for space in the queue
+    async def handle(reader, writer):
+        while line := await reader.readline():
+            line = line.decode('latin-1').strip()
+            if not line or line.startswith('fecha_hora'):
+                continue
+            if line == 'METRICS':
+                metricas_servicio['queue_depth'] = queue.qsize()
+                writer.write((json.dumps(metricas_servicio) + '\n').encode())
+                await writer.drain()
+                continue
+            campos = line.split(',')
+            reading = validate_reading(*campos[:3]) if len(campos) >= 3 else None
+            await put_reading(queue, reading)
+        writer.close()
+    return await asyncio.start_server(handle, host, port)
+
+async def directory_intake(queue, folder, interval=5):
+    #Watch the folder and read new csv files without blocking the service
+     #Files that can not be read (exm: without the columns fecha_hora, P1, Codigo) are moved to 'rechazados'
+    procesados = os.path.join(folder, 'procesados')
+    rechazados = os.path.join(folder, 'rechazados')
+    os.makedirs(procesados, exist_ok=True)
+    os.makedirs(rechazados, exist_ok=True)
+    while True:
+        for nombre in sorted(os.listdir(folder)):
+            ruta = os.path.join(folder, nombre)
+            if not nombre.endswith('.csv') or not os.path.isfile(ruta):
+                continue
+            try:
+                df = await asyncio.to_thread(pd.read_csv, ruta, encoding='latin-1', usecols=['fecha_hora', 'P1', 'Codigo'])
+            except (ValueError, OSError) as error:
+                metricas_servicio['rejected_files'] += 1
+                print(f"File {nombre} rejected: {error}")
+                shutil.move(ruta, os.path.join(rechazados, nombre))
+                continue
+            for fecha_hora, p1, codigo in df.itertuples(index=False):
+                await put_reading(queue, validate_reading(fecha_hora, p1, codigo))
+            shutil.move(ruta, os.path.join(procesados, nombre))
+        await asyncio.sleep(interval)
+
+def threshold_rain(df_model, hourly, daily, scenario):
+    #Cumulative rain in the last 24 hours and last 30 days by rain gauge and threshold exceedance for the scenario
+    ultima_hora = hourly['fecha_hora'].max()
+    lluvia_24h = hourly[hourly['fecha_hora'] > ultima_hora - pd.Timedelta(hours=24)].groupby('Codigo')['rain_hourly'].sum()
+    fechas = pd.to_datetime(daily['fecha'])
+    lluvia_30d = daily[fechas > fechas.max() - pd.Timedelta(days=30)].groupby('Codigo')['daily_rain'].sum()
+    df_model = df_model.copy()
+    df_model['rain_24h'] = df_model['codigo'].map(lluvia_24h).fillna(0).to_numpy()
+    df_model['rain_30days'] = df_model['codigo'].map(lluvia_30d).fillna(0).to_numpy()
+    df_model['threshold_24h'] = df_model['rain_24h'] >= min(umbrales_24h[scenario], default=np.inf)
+    df_model['threshold_30days'] = df_model['rain_30days'] >= min(umbrales_30d[scenario], default=np.inf)
+    return df_model
+
+def process_batch(batch, store_dir, scenario):
+    #Level 3 for a micro-batch: save readings, aggregate the last 30 days and get probability and thresholds by rain gauge
+    append_gauge_store(pd.DataFrame(batch, columns=['fecha_hora', 'P1', 'Codigo']), store_dir)
+    df = read_gauge_store(store_dir, days=31)
+
+    hourly, daily = set_hourly_daily(df)
+    df_model = cumulative_rain(daily, days_rain).rename(columns={
+        'Codigo': 'codigo', 'fecha': 'data', 'daily_rain': 'daily rain'})
+
+    #Standarize data and use the model (own scaler so the global one is not modified from the service)
+     #Rain gauges without the previous day (first day of the service or new gauge) have no antecedent rain:
+     #they are not scored (prob_ep NaN) but their thresholds are reported
+    completos = df_model[variables_l3].notna().all(axis=1).to_numpy()
+    df_model['prob_ep'] = np.nan
+    if completos.any():
+        sc_servicio = StandardScaler()
+        X_servicio = sc_servicio.fit_transform(df_model.loc[completos, variables_l3])
+        df_model.loc[completos, 'prob_ep'] = ideam_model.predict_proba(X_servicio)[:, 1]
+
+    #Cumulative rain for the thresholds
+    df_model = threshold_rain(df_model, hourly, daily, scenario)
+
+    return df_model[['codigo', 'data', 'prob_ep', 'rain_24h', 'rain_30days', 'threshold_24h', 'threshold_30days']]
+
+async def batch_worker(queue, store_dir, scenario, interval=10, on_result=print):
+    #Every 'interval' seconds take the readings in the queue and process them in a thread, intake continues meanwhile
+    while True:
+        await asyncio.sleep(interval)
+        batch = []
+        while not queue.empty():
+            batch.append(queue.get_nowait())
+        metricas_servicio['queue_depth'] = queue.qsize()
+        if not batch:
+            continue
+        inicio = pd.Timestamp.now()
+        trabajo = asyncio.ensure_future(asyncio.to_thread(process_batch, batch, store_dir, scenario))
+        try:
+            resultado = await asyncio.shield(trabajo)
+        except asyncio.CancelledError:
+            #The thread can not be stopped: the batch is finished before the service ends
+            await asyncio.wait([trabajo])
+            raise
+        except Exception as error:
+            #The service keeps running if one batch fails
+            metricas_servicio['errors'] += 1
+            print(f"Batch of {len(batch)} readings not processed: {error}")
+            continue
+        metricas_servicio['batches'] += 1
+        metricas_servicio['last_batch_size'] = len(batch)
+        metricas_servicio['last_batch_seconds'] = (pd.Timestamp.now() - inicio).total_seconds()
+        on_result(resultado)
+
+def report_task_end(tarea):
+    #Background tasks only end when the service stops; any other end is reported
+    if tarea.cancelled():
+        return
+    metricas_servicio['task_errors'] += 1
+    error = tarea.exception()
+    print(f"Service task {tarea.get_coro().__name__} stopped: {error if error is not None else 'finished'}")
+
+async def run_ingestion_service(store_dir, scenario, folder=None, host='127.0.0.1', port=8765,
+                                interval=10, max_queue=100000, on_result=print):
+    #Start TCP intake, drop directory intake (optional) and batch worker (port=0 uses a free port)
+    for clave in metricas_servicio:
+        metricas_servicio[clave] = {'last_batch_seconds': 0.0, 'port': None}.get(clave, 0)
+    queue = asyncio.Queue(maxsize=max_queue)
+    server = await tcp_intake(queue, host, port)
+    metricas_servicio['port'] = server.sockets[0].getsockname()[1]
+    tareas = [asyncio.create_task(batch_worker(queue, store_dir, scenario, interval, on_result))]
+    if folder is not None:
+        tareas.append(asyncio.create_task(directory_intake(queue, folder, interval)))
+    for tarea in tareas:
+        tarea.add_done_callback(report_task_end)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        for tarea in tareas:
+            tarea.cancel()
+        await asyncio.gather(*tareas, return_exceptions=True)
+
+#Simulated rain gauge feed to test the service
+
+async def simulated_gauge_feed(stations, start, minutes, host='127.0.0.1', port=8765, speed=0.001):
+    #Send one reading per minute and station, 'speed' is the waiting time (s) between minutes
+     #Returns the number of readings sent and the metrics of the service after receiving them
+    reader, writer = await asyncio.open_connection(host, port)
+    rng = np.random.default_rng(0)
+    enviadas = 0
+    for minuto in range(minutes):
+        fecha_hora = pd.Timestamp(start) + pd.Timedelta(minutes=minuto)
+        for codigo in stations:
+            p1 = rng.gamma(0.5, 0.4) if rng.random() < 0.1 else 0.0
+            writer.write(f"{fecha_hora:%m/%d/%Y %H:%M},{p1:.1f},{codigo}\n".encode())
+            enviadas += 1
+        await writer.drain()
+        await asyncio.sleep(speed)
+    #Ask the service for the queue metrics (answered after all the previous lines were received)
+    writer.write(b'METRICS\n')
+    await writer.drain()
+    metricas = json.loads(await reader.readline())
+    writer.close()
+    return enviadas, metricas
+
+async def test_ingestion_service(scenario, stations, start, minutes, interval=2):
+    #End to end test: service (temporary store, free port) and simulated feed running together
+    resultados = []
+    with tempfile.TemporaryDirectory() as store_dir:
+        metricas_servicio['port'] = None
+        servicio = asyncio.create_task(run_ingestion_service(store_dir, scenario, port=0, interval=interval,
+                                                             on_result=resultados.append))
+        while metricas_servicio['port'] is None:
+            await asyncio.sleep(0.1)
+        try:
+            enviadas, metricas = await simulated_gauge_feed(stations, start, minutes, port=metricas_servicio['port'])
+            #Wait the last batch
+            await asyncio.sleep(interval * 2)
+        finally:
+            #Wait the end of the service (and of a batch running in its thread) before the store is deleted
+            servicio.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await servicio
+
+    #Checks
+    if metricas['received'] != enviadas:
+        raise AssertionError(f"{enviadas} readings sent but {metricas['received']} received")
+    if metricas['invalid'] != 0:
+        raise AssertionError(f"{metricas['invalid']} valid readings marked as invalid")
+    if metricas_servicio['errors'] != 0:
+        raise AssertionError(f"{metricas_servicio['errors']} batches failed")
+    if metricas_servicio['batches'] < 1 or not resultados:
+        raise AssertionError("No batch was processed")
+    if sorted(resultados[-1]['codigo']) != sorted(stations):
+        raise AssertionError(f"Last batch has rain gauges {sorted(resultados[-1]['codigo'])}, expected {sorted(stations)}")
+    print(f"Service test passed: {enviadas} readings, {metricas_servicio['batches']} batches")
+    return resultados
+
+#Test the service with 3 simulated rain gauges and 2 days of readings (change to True to run it)
+ #In Colab "await" can be used directly in the cell
+probar_servicio = False
+if probar_servicio:
+    resultados_servicio = await test_ingestion_service(selected, [11111111, 27010770, 27015330],
+                                                       '11/1/2024 00:00', minutes=2 * 24 * 60)
+    print(resultados_servicio[-1])
 
+"""
+### **Multi-level pipeline**
+
+#### Run the three levels together and get one probability map per region with the best data available
+
+The levels are described as stages (ingest, features, score, merge, interpolate, threshold, render) with their dependencies.
+Stages that do not depend on each other run at the same time, and files used by several levels (region limits, grids, models)
+are read only once. If the input file of a level is missing, the stages of that level are skipped."""
+
+import threading
+import rasterio
+from rasterio.transform import from_bounds
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+#Input files of the pipeline (None or a missing file skips the level)
+config_pipeline = {
+    'models': {1: chirps_model_file, 2: ideam_model_file, 3: ideam_model_file},
+    'rain': {1: 'chirps_test_medellin_sanantoprado2022713.xlsx',
+             2: 'ideam_test_medellin_sanantprado2022713.xlsx',
+             3: 'prueba_pp_nivel3_3.csv'},
+    'geometry': {1: 'cuadricula_chirps_andina.shp',
+                 2: 'CNE_IDEAM_andeanregion_figprob.shp',
+                 3: 'CNE_mod.shp'},
+    'regions': {'medellin': 'medellin2.shp', 'sanantprado': 'barrio_sanantprado.shp'},
+    'store': store_lluvia_l3,
+    'scenario': selected,
+    'grid_size': 500,
+    #Gauges only give probability up to this distance (degrees), farther pixels take a lower level
+    'influence_radius': radio_influencia,
+    'output': 'pipeline_output',
+}
+
+#Shared artifacts (models, shapefiles), each one is loaded once even if several stages ask for it at the same time
+artefactos = {}
+bloqueos_artefactos = {}
+bloqueo_artefactos = threading.Lock()
+
+def shared_artifact(clave, cargar):
+    with bloqueo_artefactos:
+        bloqueo = bloqueos_artefactos.setdefault(clave, threading.Lock())
+    with bloqueo:
+        if clave not in artefactos:
+            artefactos[clave] = cargar()
+    return artefactos[clave]
+
+def read_model(ruta):
+    return shared_artifact(('model', ruta), lambda: pickle.load(open(ruta, 'rb')))
+
+def read_shapefile(ruta):
+    return shared_artifact(('shp', ruta), lambda: gpd.read_file(ruta))
+
+#Models already loaded in levels 1 and 2 are reused
+artefactos[('model', chirps_model_file)] = chirps_model
+artefactos[('model', ideam_model_file)] = ideam_model
+
+#Scheduler
+
+def run_pipeline(etapas, max_workers=4):
+    #etapas: {name: (function, required stages, optional stages)}
+    #Each function receives the results of its stages in the same order (None for a skipped optional stage).
+    #A stage that returns None is skipped, and also every stage that requires it.
+    for nombre, (_, requeridas, opcionales) in etapas.items():
+        for dependencia in list(requeridas) + list(opcionales):
+            if dependencia not in etapas:
+                raise ValueError(f"Stage {nombre} depends on unknown stage {dependencia}")
+
+    resultados, omitidas = {}, set()
+    pendientes = dict(etapas)
+    en_curso = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while pendientes or en_curso:
+            avance = False
+            for nombre, (funcion, requeridas, opcionales) in list(pendientes.items()):
+                dependencias = list(requeridas) + list(opcionales)
+                if any(d in omitidas for d in requeridas):
+                    omitidas.add(nombre)
+                elif all(d in resultados or d in omitidas for d in dependencias):
+                    en_curso[pool.submit(funcion, *[resultados.get(d) for d in dependencias])] = nombre
+                else:
+                    continue
+                del pendientes[nombre]
+                avance = True
+
+            if not en_curso:
+                if avance:
+                    continue
+                raise ValueError(f"Stages with circular dependencies: {sorted(pendientes)}")
+
+            terminadas, _ = wait(en_curso, return_when=FIRST_COMPLETED)
+            for futuro in terminadas:
+                nombre = en_curso.pop(futuro)
+                resultado = futuro.result()
+                if resultado is None:
+                    omitidas.add(nombre)
+                else:
+                    resultados[nombre] = resultado
+    return resultados, omitidas
+
+#Stages
+
+def ingest_stage(nivel, config):
+    #Read the rain file of the level, None if it is not available
+    ruta = config['rain'].get(nivel)
+    if ruta is None or not os.path.exists(ruta):
+        return None
+    if nivel == 3:
+        df = pd.read_csv(ruta, encoding='latin-1')
+        df['fecha_hora'] = pd.to_datetime(df['fecha_hora'])
+        append_gauge_store(df, config['store'])
+        return read_gauge_store(config['store'], days=31)
+    return cargar_archivo(ruta).dropna()
+
+def features_stage(nivel, df):
+    #Model variables; level 3 gets them from hourly/daily rain
+    if nivel == 3:
+        hourly, daily = set_hourly_daily(df)
+        df_model = cumulative_rain(daily, days_rain).rename(columns={
+            'Codigo': 'codigo', 'fecha': 'data', 'daily_rain': 'daily rain'})
+        return {'model_input': df_model, 'hourly': hourly, 'daily': daily}
+    return {'model_input': df}
+
+def score_stage(nivel, config, features):
+    ruta = config['models'].get(nivel)
+    if ruta is None or (not os.path.exists(ruta) and ('model', ruta) not in artefactos):
+        return None
+    modelo = read_model(ruta)
+    df = features['model_input'].copy()
+    X_pipeline = StandardScaler().fit_transform(df[variables_l3])
+    df['prob_ep'] = modelo.predict_proba(X_pipeline)[:, 1]
+    return df
+
+def merge_stage(nivel, config, df):
+    #Join probability with the CHIRPS cells (level 1) or the rain gauges catalogue (levels 2 and 3)
+    ruta = config['geometry'].get(nivel)
+    if ruta is None or not os.path.exists(ruta):
+        return None
+    if nivel == 1:
+        geometria = read_shapefile(ruta)
+        unido = pd.merge(geometria[['OBJECTID', 'geometry']], df[['ID_pixel', 'prob_ep']],
+                         how='inner', left_on='OBJECTID', right_on='ID_pixel').dropna(subset=['prob_ep'])
+        return gpd.GeoDataFrame(unido, geometry='geometry', crs=geometria.crs)
+    catalogo = shared_artifact(('stations', ruta), lambda: station_catalogue(ruta))
+    x, y, prob = join_stations(catalogo, df['codigo'], df['prob_ep'])
+    return {'x': x, 'y': y, 'prob_ep': prob}
+
+def regions_stage(config):
+    #Region limits, grid and mask (pixels inside the region) shared by every level
+    regiones = {}
+    n = complex(0, config['grid_size'])
+    for nombre, ruta in config['regions'].items():
+        if not os.path.exists(ruta):
+            continue
+        limite = read_shapefile(ruta)
+        min_x, min_y, max_x, max_y = limite.total_bounds
+        grid_x, grid_y = np.mgrid[min_x:max_x:n, min_y:max_y:n]
+        regiones[nombre] = {'limit': limite, 'grid': (grid_x, grid_y),
+                            'mask': shapely.contains_xy(limite.union_all(), grid_x, grid_y),
+                            'bounds': (min_x, min_y, max_x, max_y)}
+    return regiones or None
+
+def interpolate_stage(nivel, config, gdf, regiones):
+    #Probability raster of the level for every region (Nan where the level has no data)
+    #gdf: CHIRPS cells (level 1) or coordinates and probability of rain gauges (levels 2 and 3)
+    rasters = {}
+    for nombre, region in regiones.items():
+        grid_x, grid_y = region['grid']
+        mascara = region['mask'].ravel()
+        if nivel == 1:
+            #Value of the CHIRPS cell that contains each pixel
+            raster = np.full(grid_x.size, np.nan)
+            pixeles = gpd.GeoDataFrame(geometry=gpd.points_from_xy(grid_x.ravel()[mascara], grid_y.ravel()[mascara]),
+                                       index=np.flatnonzero(mascara), crs=gdf.crs)
+            dentro = gpd.sjoin(pixeles, gdf[['geometry', 'prob_ep']], predicate='within', how='inner')
+            dentro = dentro[~dentro.index.duplicated()]
+            raster[dentro.index] = dentro['prob_ep'].to_numpy()
+            raster = raster.reshape(grid_x.shape)
+        else:
+            raster = idw_interpolation(gdf['x'], gdf['y'], gdf['prob_ep'], grid_x, grid_y,
+                                       power=2, max_distance=config['influence_radius'])
+        raster[~region['mask']] = np.nan
+        rasters[nombre] = raster
+    return rasters
+
+def threshold_stage(config, features, df):
+    #Empirical rainfall thresholds of level 3 by rain gauge
+    return threshold_rain(df, features['hourly'], features['daily'], config['scenario'])
+
+def fuse_stage(regiones, *rasters_niveles):
+    #One raster per region: each pixel takes the highest level with data (3, then 2, then 1)
+    fusion = {}
+    for nombre, region in regiones.items():
+        probabilidad = np.full(region['mask'].shape, np.nan, dtype='float32')
+        nivel_pixel = np.zeros(region['mask'].shape, dtype='int8')
+        for nivel in (3, 2, 1):
+            rasters = rasters_niveles[nivel - 1]
+            if rasters is None:
+                continue
+            libres = np.isnan(probabilidad) & np.isfinite(rasters[nombre])
+            probabilidad[libres] = rasters[nombre][libres]
+            nivel_pixel[libres] = nivel
+        fusion[nombre] = {'probability': probabilidad, 'level': nivel_pixel}
+    return fusion
+
+def render_stage(config, regiones, fusion, alertas):
+    #Save the fused raster (GeoTIFF: band 1 probability, band 2 level used) and a map (PNG) by region
+    os.makedirs(config['output'], exist_ok=True)
+    archivos = []
+    for nombre, resultado in fusion.items():
+        region = regiones[nombre]
+        min_x, min_y, max_x, max_y = region['bounds']
+        filas, columnas = resultado['probability'].T.shape
+
+        ruta_tif = os.path.join(config['output'], f'probability_{nombre}.tif')
+        with rasterio.open(ruta_tif, 'w', driver='GTiff', height=filas, width=columnas, count=2, dtype='float32',
+                           crs=region['limit'].crs, transform=from_bounds(min_x, min_y, max_x, max_y, columnas, filas),
+                           nodata=np.nan) as raster:
+            raster.write(np.flipud(resultado['probability'].T), 1)
+            raster.write(np.flipud(resultado['level'].T).astype('float32'), 2)
+
+        fig = Figure()
+        ax = fig.subplots()
+        ax.set_title(f"Landslide probability (best level available) - {nombre}", fontsize=12)
+        region['limit'].boundary.plot(ax=ax, color='black', edgecolor='black')
+        cax = ax.imshow(resultado['probability'].T, extent=(min_x, max_x, min_y, max_y),
+                        origin='lower', cmap='YlGnBu', vmin=0, vmax=1)
+        fig.colorbar(cax, label='Landslide probability [0-1]')
+        ax.xaxis.set_major_formatter(FuncFormatter(format_two_decimals))
+        ax.yaxis.set_major_formatter(FuncFormatter(format_two_decimals))
+        ax.set_xlabel("Longitude", fontsize=10)
+        ax.set_ylabel("Latitude", fontsize=10)
+        ruta_png = os.path.join(config['output'], f'probability_{nombre}.png')
+        fig.savefig(ruta_png, dpi=150, bbox_inches='tight')
+        archivos += [ruta_tif, ruta_png]
+
+    if alertas is not None:
+        ruta_csv = os.path.join(config['output'], 'thresholds_level3.csv')
+        alertas.to_csv(ruta_csv, index=False)
+        archivos.append(ruta_csv)
+    return archivos
+
+def pipeline_stages(config):
+    #DAG of the multi-level pipeline
+    etapas = {'regions': (lambda: regions_stage(config), [], [])}
+    for nivel in (1, 2, 3):
+        etapas[f'ingest_l{nivel}'] = (lambda nivel=nivel: ingest_stage(nivel, config), [], [])
+        etapas[f'features_l{nivel}'] = (lambda df, nivel=nivel: features_stage(nivel, df), [f'ingest_l{nivel}'], [])
+        etapas[f'score_l{nivel}'] = (lambda features, nivel=nivel: score_stage(nivel, config, features),
+                                     [f'features_l{nivel}'], [])
+        etapas[f'merge_l{nivel}'] = (lambda df, nivel=nivel: merge_stage(nivel, config, df), [f'score_l{nivel}'], [])
+        etapas[f'interpolate_l{nivel}'] = (lambda gdf, regiones, nivel=nivel: interpolate_stage(nivel, config, gdf, regiones),
+                                           [f'merge_l{nivel}', 'regions'], [])
+    etapas['threshold'] = (lambda features, df: threshold_stage(config, features, df), ['features_l3', 'score_l3'], [])
+    etapas['fuse'] = (fuse_stage, ['regions'], ['interpolate_l1', 'interpolate_l2', 'interpolate_l3'])
+    etapas['render'] = (lambda regiones, fusion, alertas: render_stage(config, regiones, fusion, alertas),
+                        ['regions', 'fuse'], ['threshold'])
+    return etapas
+
+#Run the pipeline
+resultados_pipeline, omitidas_pipeline = run_pipeline(pipeline_stages(config_pipeline))
+print("Skipped stages:", sorted(omitidas_pipeline))
+print("Files saved:", resultados_pipeline.get('render'))
+
+"""
+### **Hindcast and skill evaluation**
+
+#### Replay a period of daily rain through the models and compare with a landslide inventory
+
+The period is divided in blocks of days that are scored in parallel processes (each block reads its days and the 30 previous days).
+Results of every block are saved to disk and only the counts needed for the skill metrics are kept in memory.
+A checkpoint file saves the finished blocks, so an interrupted run continues from where it stopped."""
+
+import hashlib
+
+#Daily rain history of levels 1 and 2 uses the same storage of level 3 (one reading per day, partitioned only by month):
+ #fecha_hora = day, P1 = daily rain, Codigo = ID_pixel (level 1) or codigo (level 2)
+def save_daily_history(df, store_dir, id_col):
+    append_gauge_store(df.rename(columns={'data': 'fecha_hora', 'daily rain': 'P1', id_col: 'Codigo'}), store_dir,
+                       partitioning=particion_mes)
+
+#The daily rain of levels 1 and 2 uploaded above is added to the histories (days already stored are skipped).
+ #To replay a longer period, load older files with the same format and save them in the same way.
+store_diario_l1 = 'daily_store_l1'
+store_diario_l2 = 'daily_store_l2'
+if 'df_chirps' in globals():
+    save_daily_history(df_chirps, store_diario_l1, 'ID_pixel')
+if 'df_lluvia_l2' in globals():
+    save_daily_history(df_lluvia_l2, store_diario_l2, 'codigo')
+
+#Input files of the hindcast (levels without store are skipped)
+config_hindcast = {
+    'start': '2024-11-01',
+    'end': '2024-11-30',
+    'block_days': 30,
+    'models': {1: chirps_model_file, 2: ideam_model_file, 3: ideam_model_file},
+    'rain': {1: store_diario_l1, 2: store_diario_l2, 3: store_lluvia_l3},
+    'geometry': config_pipeline['geometry'],
+    'regions': config_pipeline['regions'],
+    'influence_radius': radio_influencia,
+    #Landslide inventory: csv with columns fecha (date), x, y (longitude, latitude)
+    'inventory': 'landslide_inventory.csv',
+    #Landslides farther than this distance (degrees) from every rain gauge are not used for levels 2 and 3
+    'inventory_radius': 0.05,
+    #Probability used to define the alarm of the model
+    'cutoff': 0.5,
+    'bins': 100,
+    'workers': 4,
+    'output': 'hindcast_output',
+}
+
+def antecedent_rain(daily):
+    #Antecedent rain for every day and rain gauge/pixel (same definition as cumulative_rain, without loops)
+    daily = daily.sort_values(by=['Codigo', 'fecha'], ignore_index=True)
+    acumulada = daily.groupby('Codigo')['daily_rain'].cumsum()
+    anterior = acumulada.groupby(daily['Codigo']).shift(1)
+    for days in days_rain:
+        ventana = anterior - acumulada.groupby(daily['Codigo']).shift(1 + days).fillna(0)
+        daily[f'{days}-rain ant.rain'] = ventana + daily['daily_rain']
+    return daily.rename(columns={'daily_rain': 'daily rain'})
+
+def hindcast_units(nivel, config):
+    #Catalogue (codigo, x, y, crs) of the rain gauges or CHIRPS cells (center) of the level
+    ruta = config['geometry'][nivel]
+    if nivel == 1:
+        celdas = gpd.read_file(ruta, columns=['OBJECTID'])
+        limites = celdas.bounds
+        return {'codigo': celdas['OBJECTID'].to_numpy(dtype='int64'),
+                'x': ((limites['minx'] + limites['maxx']) / 2).to_numpy(),
+                'y': ((limites['miny'] + limites['maxy']) / 2).to_numpy(), 'crs': celdas.crs}, celdas
+    return station_catalogue(ruta), None
+
+def prepare_hindcast(nivel, config, inventario):
+    #Rain gauges/cells of each region and landslides (code, day) of the level, computed once for all the blocks
+    catalogo, celdas = hindcast_units(nivel, config)
+    codigos, x, y = catalogo['codigo'], catalogo['x'], catalogo['y']
+    #Same selection as the threshold charts: inside the region or at less than the influence radius
+    regiones = {'all': None}
+    for nombre, ruta in config['regions'].items():
+        if os.path.exists(ruta):
+            regiones[nombre] = stations_near_region(catalogo, gpd.read_file(ruta), config['influence_radius'])
+
+    if nivel == 1:
+        #Landslides inside each CHIRPS cell
+        puntos = gpd.GeoDataFrame(inventario[['fecha']], geometry=gpd.points_from_xy(inventario['x'], inventario['y']), crs=celdas.crs)
+        dentro = gpd.sjoin(puntos, celdas, predicate='within', how='inner')
+        eventos = pd.DataFrame({'Codigo': dentro['OBJECTID'].to_numpy(dtype='int64'), 'fecha': dentro['fecha'].to_numpy()})
+    else:
+        #Landslides assigned to the nearest rain gauge (inside the radius)
+        dist = np.hypot(inventario['x'].to_numpy()[:, None] - x[None, :], inventario['y'].to_numpy()[:, None] - y[None, :])
+        cercano = dist.argmin(axis=1)
+        dentro = dist[np.arange(len(cercano)), cercano] <= config['inventory_radius']
+        eventos = pd.DataFrame({'Codigo': codigos[cercano[dentro]], 'fecha': inventario['fecha'].to_numpy()[dentro]})
+    eventos['fecha'] = pd.to_datetime(eventos['fecha']).dt.normalize().astype('datetime64[ns]')
+    return regiones, eventos.drop_duplicates()
+
+def hindcast_blocks(config):
+    #Blocks of days of the period (first day, last day)
+    inicio = pd.Timestamp(config['start'])
+    fin = pd.Timestamp(config['end'])
+    while inicio <= fin:
+        ultimo = min(inicio + pd.Timedelta(days=config['block_days'] - 1), fin)
+        yield inicio, ultimo
+        inicio = ultimo + pd.Timedelta(days=1)
+
+#Models loaded in every process (once per process)
+modelos_proceso = {}
+
+def hindcast_block(nivel, inicio, fin, config, regiones, eventos):
+    #Score every rain gauge/pixel of every day of the block and return the counts for the skill metrics
+    ruta = config['models'][nivel]
+    if ruta not in modelos_proceso:
+        modelos_proceso[ruta] = pickle.load(open(ruta, 'rb'))
+
+    #Days of the block and 30 previous days (antecedent rain)
+    lecturas = read_gauge_store(config['rain'][nivel], days=(fin - inicio).days + 31,
+                                end=fin + pd.Timedelta(days=1) - pd.Timedelta(nanoseconds=1),
+                                partitioning=particion_lluvia if nivel == 3 else particion_mes)
+    if len(lecturas) == 0:
+        return None
+    if nivel == 3:
+        _, daily = set_hourly_daily(lecturas)
+        daily = daily[['fecha', 'Codigo', 'daily_rain']]
+    else:
+        daily = lecturas.rename(columns={'fecha_hora': 'fecha', 'P1': 'daily_rain'})
+        daily['fecha'] = daily['fecha'].dt.normalize()
+    df = antecedent_rain(daily)
+    df = df[(df['fecha'] >= inicio) & (df['fecha'] <= fin)].dropna(subset=variables_l3)
+    if len(df) == 0:
+        return None
+
+    #Standarize every day as the map of one day is standarized in levels 1 and 2, and score the whole block at once
+    X_dia = df[variables_l3].astype('float64')
+    media = X_dia.groupby(df['fecha']).transform('mean')
+    desviacion = X_dia.groupby(df['fecha']).transform('std', ddof=0).replace(0, 1)
+    df['prob_ep'] = modelos_proceso[ruta].predict_proba(((X_dia - media) / desviacion).to_numpy())[:, 1]
+
+    #Observed landslides
+    eventos = eventos.assign(event=True)
+    df = df.merge(eventos, how='left', on=['Codigo', 'fecha'])
+    df['event'] = df['event'].fillna(False).astype(bool)
+
+    #Save the results of the block
+    carpeta = os.path.join(config['output'], f'level{nivel}')
+    os.makedirs(carpeta, exist_ok=True)
+    df[['fecha', 'Codigo', 'daily rain', '30-rain ant.rain', 'prob_ep', 'event']].to_parquet(
+        os.path.join(carpeta, f'{inicio:%Y%m%d}_{fin:%Y%m%d}.parquet'), index=False)
+
+    #Counts by region: probability histogram of days with/without landslide and contingency table of the scenarios
+     #(daily rain is used as the 24 hours cumulative rain)
+    conteos = {}
+    bordes = np.linspace(0, 1, config['bins'] + 1)
+    for region, codigos in regiones.items():
+        dr = df if codigos is None else df[df['Codigo'].isin(codigos)]
+        evento = dr['event'].to_numpy()
+        conteos[f'{nivel}|{region}|model'] = {
+            'events': np.histogram(dr['prob_ep'][evento], bordes)[0].tolist(),
+            'no_events': np.histogram(dr['prob_ep'][~evento], bordes)[0].tolist()}
+        for scenario in (1, 2, 3):
+            alarma = ((dr['daily rain'] >= min(umbrales_24h[scenario], default=np.inf)) |
+                      (dr['30-rain ant.rain'] >= min(umbrales_30d[scenario], default=np.inf))).to_numpy()
+            conteos[f'{nivel}|{region}|{scenario}'] = {
+                'hits': int((alarma & evento).sum()), 'misses': int((~alarma & evento).sum()),
+                'false_alarms': int((alarma & ~evento).sum()), 'correct_negatives': int((~alarma & ~evento).sum())}
+    return conteos
+
+def add_counts(acumulados, conteos):
+    #Add the counts of one block to the totals
+    for clave, valores in conteos.items():
+        total = acumulados.setdefault(clave, {k: (np.zeros_like(v) if isinstance(v, list) else 0) for k, v in valores.items()})
+        for k, v in valores.items():
+            total[k] = (np.asarray(total[k]) + np.asarray(v)).tolist() if isinstance(v, list) else total[k] + v
+
+def hindcast_fingerprint(config):
+    #Hash of the options that change the counts of the blocks (and of the inventory content)
+    campos = {clave: config[clave] for clave in ('start', 'end', 'block_days', 'models', 'rain', 'geometry',
+                                                 'regions', 'influence_radius', 'inventory', 'inventory_radius', 'bins')}
+    huella = hashlib.sha256(json.dumps(campos, sort_keys=True, default=str).encode())
+    with open(config['inventory'], 'rb') as archivo:
+        huella.update(archivo.read())
+    #Files of the rain histories (name, size and modification time of every partition file):
+     #days added later to a history change the blocks already scored
+    for nivel, store in sorted(config['rain'].items()):
+        for carpeta, _, archivos in sorted(os.walk(store)):
+            for nombre in sorted(archivos):
+                estado = os.stat(os.path.join(carpeta, nombre))
+                ruta = os.path.relpath(os.path.join(carpeta, nombre), store)
+                huella.update(f'{nivel}|{ruta}|{estado.st_size}|{estado.st_mtime_ns}'.encode())
+    return huella.hexdigest()
+
+def save_checkpoint(ruta, huella, terminados, acumulados):
+    #Write to a temporary file and replace, so an interruption does not leave a broken checkpoint
+    with open(ruta + '.tmp', 'w') as archivo:
+        json.dump({'config': huella, 'done': sorted(terminados), 'counts': acumulados}, archivo)
+    os.replace(ruta + '.tmp', ruta)
+
+def run_hindcast(config):
+    #Score all the blocks of all the levels in parallel processes, resuming from the checkpoint if it exists
+    os.makedirs(config['output'], exist_ok=True)
+    ruta_checkpoint = os.path.join(config['output'], 'checkpoint.json')
+    huella = hindcast_fingerprint(config)
+    terminados, acumulados = set(), {}
+    if os.path.exists(ruta_checkpoint):
+        with open(ruta_checkpoint) as archivo:
+            checkpoint = json.load(archivo)
+        #Counts of a different configuration can not be mixed with the new blocks
+        if checkpoint.get('config') != huella:
+            raise ValueError(f"{ruta_checkpoint} was created with a different configuration "
+                             f"(period, blocks, inventory, regions, rain histories...). Delete it or use another output folder.")
+        terminados, acumulados = set(checkpoint['done']), checkpoint['counts']
+
+    inventario = pd.read_csv(config['inventory'])
+    tareas, niveles = [], []
+    for nivel in (1, 2, 3):
+        if not os.path.exists(config['rain'][nivel]) or not os.path.exists(config['geometry'][nivel]):
+            print(f"Level {nivel} skipped (no rain history or geometry)")
+            continue
+        niveles.append(nivel)
+        regiones, eventos = prepare_hindcast(nivel, config, inventario)
+        for inicio, fin in hindcast_blocks(config):
+            clave = f'{nivel}|{inicio:%Y%m%d}'
+            if clave not in terminados:
+                bloque_eventos = eventos[(eventos['fecha'] >= inicio) & (eventos['fecha'] <= fin)]
+                tareas.append((clave, (nivel, inicio, fin, config, regiones, bloque_eventos)))
+
+    #"fork" lets the processes use the functions defined in this notebook
+    with ProcessPoolExecutor(max_workers=config['workers'], mp_context=multiprocessing.get_context('fork')) as pool:
+        en_curso = {}
+        while tareas or en_curso:
+            #At most two blocks per process are waiting, results are added as soon as they finish
+            while tareas and len(en_curso) < 2 * config['workers']:
+                clave, argumentos = tareas.pop(0)
+                en_curso[pool.submit(hindcast_block, *argumentos)] = clave
+            terminadas, _ = wait(en_curso, return_when=FIRST_COMPLETED)
+            for futuro in terminadas:
+                clave = en_curso.pop(futuro)
+                conteos = futuro.result()
+                if conteos is not None:
+                    add_counts(acumulados, conteos)
+                terminados.add(clave)
+                save_checkpoint(ruta_checkpoint, huella, terminados, acumulados)
+
+    #Levels without scored days: the first day of a history has no antecedent rain, so at least two days are needed
+    for nivel in niveles:
+        if not any(clave.startswith(f'{nivel}|') for clave in acumulados):
+            print(f"Level {nivel}: no data in period {config['start']} to {config['end']} "
+                  f"(rain history needs the period days and the day before)")
+    return skill_metrics(acumulados, config)
+
+def skill_metrics(acumulados, config):
+    #Skill by level, scenario (model probability or empirical thresholds) and region
+    filas = []
+    for clave, c in acumulados.items():
+        nivel, region, scenario = clave.split('|')
+        if scenario == 'model':
+            eventos, no_eventos = np.asarray(c['events'], float), np.asarray(c['no_events'], float)
+            #ROC curve from the highest to the lowest probability
+            pod = np.concatenate([[0], np.cumsum(eventos[::-1])]) / max(eventos.sum(), 1)
+            pofd = np.concatenate([[0], np.cumsum(no_eventos[::-1])]) / max(no_eventos.sum(), 1)
+            corte = int(round(config['cutoff'] * config['bins']))
+            hits, misses = eventos[corte:].sum(), eventos[:corte].sum()
+            false_alarms, correct_negatives = no_eventos[corte:].sum(), no_eventos[:corte].sum()
+            auc = np.sum(np.diff(pofd) * (pod[1:] + pod[:-1]) / 2) if eventos.sum() and no_eventos.sum() else np.nan
+        else:
+            hits, misses, false_alarms, correct_negatives = c['hits'], c['misses'], c['false_alarms'], c['correct_negatives']
+            auc = None
+        hit_rate = hits / (hits + misses) if hits + misses else np.nan
+        false_alarm_rate = false_alarms / (false_alarms + correct_negatives) if false_alarms + correct_negatives else np.nan
+        if auc is None:
+            #One point ROC curve
+            auc = (hit_rate + 1 - false_alarm_rate) / 2
+        filas.append({'level': int(nivel), 'scenario': scenario, 'region': region,
+                      'days': int(hits + misses + false_alarms + correct_negatives), 'events': int(hits + misses),
+                      'hit_rate': hit_rate, 'false_alarm_rate': false_alarm_rate,
+                      'false_alarm_ratio': false_alarms / (hits + false_alarms) if hits + false_alarms else np.nan,
+                      'auc': auc})
+    columnas = ['level', 'scenario', 'region', 'days', 'events', 'hit_rate', 'false_alarm_rate', 'false_alarm_ratio', 'auc']
+    return pd.DataFrame(filas, columns=columnas).sort_values(by=['level', 'region', 'scenario'], ignore_index=True)
+
+#Run the hindcast (if it is interrupted, run again the cell to continue)
+ #The landslide inventory is not included in Input-data, the user must provide it
+if os.path.exists(config_hindcast['inventory']):
+    skill_hindcast = run_hindcast(config_hindcast)
+    print(skill_hindcast)
+else:
+    print(f"Hindcast not run: landslide inventory {config_hindcast['inventory']} not found")